@@ -0,0 +1,297 @@
+"""
+Reconcilia los archivos de PATH_SUCURSALES con la tabla documents_documents.
+
+Recorre el árbol de sucursales en paralelo y compara cada carpeta contra la base de datos por
+lotes. Detecta archivos sin registro, registros que apuntan a archivos movidos y tamaños
+desactualizados. Sin --aplicar solo reporta las diferencias.
+
+Uso:
+    python reconciliar_valija_digital.py [--aplicar] [--verificar-paginas]
+"""
+import argparse
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from valija_digital import DatabaseManager, Logger, PDFProcessor, ValijaDigitalConfig
+
+# Un archivo modificado después de su último log pudo haberse unido sin actualizar su tamaño.
+TOLERANCIA_MODIFICACION = 120
+# El servicio mueve el archivo y lo inserta unos segundos después. Un archivo sin registro se
+# vuelve a consultar pasado este tiempo antes de insertarlo, para no duplicar el registro del servicio.
+ESPERA_FALTANTES = 30
+
+def contar_paginas(path_documento):
+    return path_documento, PDFProcessor(None, None).get_size(path_documento)
+
+class RecorridoParalelo:
+    """Recorre un árbol con os.scandir en varios hilos y entrega (carpeta, {nombre: mtime}) por carpeta."""
+    def __init__(self, path_raiz, hilos):
+        self.path_raiz = path_raiz
+        self.hilos = hilos
+        self.cola = queue.Queue()
+        self.pendientes = 0
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def __iter__(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.hilos)
+        self._programar(self.path_raiz)
+        try:
+            while True:
+                carpeta = self.cola.get()
+                if carpeta is None:
+                    break
+                yield carpeta
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _programar(self, path):
+        with self.lock:
+            self.pendientes += 1
+        self.executor.submit(self._recorrer, path)
+
+    def _recorrer(self, path):
+        archivos = {}
+        try:
+            with os.scandir(path) as entradas:
+                for entrada in entradas:
+                    try:
+                        if entrada.is_dir(follow_symlinks=False):
+                            self._programar(entrada.path)
+                        elif entrada.name.lower().endswith('.pdf'):
+                            archivos[entrada.name] = entrada.stat().st_mtime
+                    except OSError as e:
+                        logging.error(f'Error al leer {entrada.path}: {e}')
+            self.cola.put((path, archivos))
+        except OSError as e:
+            logging.error(f'Error al leer la carpeta {path}: {e}')
+        finally:
+            with self.lock:
+                self.pendientes -= 1
+                terminado = self.pendientes == 0
+            if terminado:
+                self.cola.put(None)
+
+class Reconciliador:
+    def __init__(self, config, database_manager, hilos, procesos, lote, aplicar, verificar_paginas):
+        self.config = config
+        self.database_manager = database_manager
+        self.hilos = hilos
+        self.procesos = procesos
+        self.lote = lote
+        self.aplicar = aplicar
+        self.verificar_paginas = verificar_paginas
+        self.faltantes = []
+        self.huerfanos = []
+        self.carpetas_recorridas = set()
+        self.estadisticas = {
+            'carpetas': 0, 'archivos': 0, 'faltantes': 0, 'huerfanos': 0,
+            'paginas_verificadas': 0, 'verificados': 0, 'tamanios': 0, 'reubicados': 0, 'insertados': 0, 'fallos': 0,
+        }
+        self.inicio = time.monotonic()
+        self.ultimo_progreso = self.inicio
+
+    def ejecutar(self):
+        if not self.config.PATH_SUCURSALES or not os.path.isdir(self.config.PATH_SUCURSALES):
+            logging.error('PATH_SUCURSALES no es una carpeta válida')
+            return False
+
+        with ProcessPoolExecutor(max_workers=self.procesos) as pool:
+            self.pool = pool
+            lote = []
+            for carpeta, archivos in RecorridoParalelo(self.config.PATH_SUCURSALES, self.hilos):
+                lote.append((carpeta, archivos))
+                if len(lote) >= self.lote:
+                    if not self._procesar_lote(lote):
+                        return False
+                    lote = []
+            if lote and not self._procesar_lote(lote):
+                return False
+
+            if not self._procesar_carpetas_inexistentes():
+                return False
+            self._resolver_faltantes_y_huerfanos()
+
+        self._reportar_progreso(forzar=True)
+        for documento in self.huerfanos:
+            logging.warning(f"Documento {documento['id']} sin archivo: "
+                            f"{os.path.join(documento['current_path'], documento['name'])}")
+        return True
+
+    def _procesar_lote(self, lote):
+        documentos = self.database_manager.get_documentos_por_carpeta([carpeta for carpeta, _ in lote])
+        if documentos is None:
+            logging.error('No se pudo consultar la base de datos, se detiene la reconciliación')
+            return False
+
+        por_verificar = []
+        for carpeta, archivos in lote:
+            self.carpetas_recorridas.add(carpeta)
+            self.estadisticas['carpetas'] += 1
+            self.estadisticas['archivos'] += len(archivos)
+            registrados = documentos.get(carpeta, {})
+            for nombre, mtime in archivos.items():
+                documento = registrados.get(nombre)
+                if not documento:
+                    self.faltantes.append({'name': nombre, 'current_path': carpeta, 'visto': time.monotonic()})
+                else:
+                    documento['modificado'] = self._modificado_despues_de_log(documento, mtime)
+                    if self.verificar_paginas or not documento['size'] or documento['modificado']:
+                        por_verificar.append(documento)
+            self.huerfanos.extend(documento for nombre, documento in registrados.items() if nombre not in archivos)
+
+        tamanios = []
+        verificados = []
+        for documento, paginas in self._contar_paginas(por_verificar):
+            if paginas and paginas != documento['size']:
+                documento['size'] = paginas
+                tamanios.append(documento)
+            elif paginas and documento['modificado']:
+                # Sin un log posterior al archivo se volvería a contar en cada ejecución.
+                verificados.append(documento)
+        self.estadisticas['tamanios'] += len(tamanios)
+        self.estadisticas['verificados'] += len(verificados)
+        self._reparar(tamanios=tamanios, verificados=verificados)
+        self._reportar_progreso()
+        return True
+
+    def _modificado_despues_de_log(self, documento, mtime):
+        try:
+            ultima_modificacion = datetime.strptime(documento['ultima_modificacion'], '%Y-%m-%d %H:%M:%S')
+        except (TypeError, ValueError):
+            return True
+        ultima_modificacion = ultima_modificacion.replace(tzinfo=timezone.utc).timestamp()
+        return mtime > ultima_modificacion + TOLERANCIA_MODIFICACION
+
+    def _contar_paginas(self, documentos):
+        if not documentos:
+            return []
+        self.estadisticas['paginas_verificadas'] += len(documentos)
+        paths = [os.path.join(documento['current_path'], documento['name']) for documento in documentos]
+        paginas = dict(self.pool.map(contar_paginas, paths, chunksize=16))
+        return [(documento, paginas[path]) for documento, path in zip(documentos, paths)]
+
+    def _procesar_carpetas_inexistentes(self):
+        """Los registros en carpetas de PATH_SUCURSALES que ya no existen también son huérfanos."""
+        carpetas = self.database_manager.get_carpetas_documentos()
+        if carpetas is None:
+            logging.error('No se pudo consultar la base de datos, se detiene la reconciliación')
+            return False
+        raiz = os.path.join(os.path.normcase(os.path.abspath(self.config.PATH_SUCURSALES)), '')
+        inexistentes = [carpeta for carpeta in carpetas
+                        if carpeta not in self.carpetas_recorridas
+                        and os.path.normcase(os.path.abspath(carpeta)).startswith(raiz)]
+        for i in range(0, len(inexistentes), self.lote):
+            documentos = self.database_manager.get_documentos_por_carpeta(inexistentes[i:i + self.lote])
+            if documentos is None:
+                logging.error('No se pudo consultar la base de datos, se detiene la reconciliación')
+                return False
+            for registrados in documentos.values():
+                self.huerfanos.extend(registrados.values())
+        return True
+
+    def _resolver_faltantes_y_huerfanos(self):
+        # Un registro huérfano y un archivo sin registro con el mismo nombre, ambos únicos, son un archivo movido.
+        faltantes_por_nombre = {}
+        for documento in self.faltantes:
+            faltantes_por_nombre.setdefault(documento['name'], []).append(documento)
+        huerfanos_por_nombre = {}
+        for documento in self.huerfanos:
+            huerfanos_por_nombre.setdefault(documento['name'], []).append(documento)
+
+        reubicados = []
+        for nombre, huerfanos in huerfanos_por_nombre.items():
+            faltantes = faltantes_por_nombre.get(nombre, [])
+            if len(huerfanos) == 1 and len(faltantes) == 1:
+                documento = dict(huerfanos[0])
+                documento['path_anterior'] = documento['current_path']
+                documento['current_path'] = faltantes[0]['current_path']
+                reubicados.append(documento)
+                del faltantes_por_nombre[nombre]
+        reubicados_ids = {documento['id'] for documento in reubicados}
+        self.huerfanos = [documento for documento in self.huerfanos if documento['id'] not in reubicados_ids]
+        nuevos = [documento for faltantes in faltantes_por_nombre.values() for documento in faltantes]
+
+        self.estadisticas['faltantes'] = len(nuevos)
+        self.estadisticas['huerfanos'] = len(self.huerfanos)
+        self.estadisticas['reubicados'] = len(reubicados)
+
+        documentos = reubicados + nuevos
+        for documento, paginas in self._contar_paginas(documentos):
+            documento['size'] = paginas
+        if self.aplicar and nuevos:
+            espera = max(documento['visto'] for documento in nuevos) + ESPERA_FALTANTES - time.monotonic()
+            if espera > 0:
+                logging.info(f'Esperando {espera:.0f} s antes de volver a consultar los archivos sin registro')
+                time.sleep(espera)
+
+        for i in range(0, len(documentos), self.lote):
+            lote = documentos[i:i + self.lote]
+            nuevos_lote = self._aun_sin_registro([documento for documento in lote if 'id' not in documento])
+            if self._reparar(nuevos=nuevos_lote, reubicados=[documento for documento in lote if 'id' in documento]):
+                self.estadisticas['insertados'] += len(nuevos_lote)
+            self._reportar_progreso()
+
+    def _aun_sin_registro(self, nuevos):
+        """Descarta los archivos que el servicio registró después de que se recorrió su carpeta."""
+        if not self.aplicar or not nuevos:
+            return nuevos
+        documentos = self.database_manager.get_documentos_por_carpeta(
+            list({documento['current_path'] for documento in nuevos}))
+        if documentos is None:
+            return []
+        return [documento for documento in nuevos
+                if documento['name'] not in documentos.get(documento['current_path'], {})]
+
+    def _reparar(self, nuevos=(), tamanios=(), reubicados=(), verificados=()):
+        """Aplica las correcciones; regresa True solo si se aplicaron."""
+        if not self.aplicar or not (nuevos or tamanios or reubicados or verificados):
+            return False
+        if not self.database_manager.reparar_documentos(nuevos=nuevos, tamanios=tamanios, reubicados=reubicados,
+                                                        verificados=verificados):
+            self.estadisticas['fallos'] += len(nuevos) + len(tamanios) + len(reubicados)
+            return False
+        return True
+
+    def _reportar_progreso(self, forzar=False):
+        ahora = time.monotonic()
+        if not forzar and ahora - self.ultimo_progreso < 5:
+            return
+        self.ultimo_progreso = ahora
+        transcurrido = ahora - self.inicio
+        velocidad = self.estadisticas['archivos'] / transcurrido if transcurrido else 0
+        resumen = '  '.join(f'{clave}={valor}' for clave, valor in self.estadisticas.items())
+        modo = 'aplicado' if self.aplicar else 'simulación'
+        logging.info(f'[{modo}] {resumen}  ({velocidad:.0f} archivos/s, {transcurrido:.0f} s)')
+
+def main():
+    parser = argparse.ArgumentParser(description='Reconcilia PATH_SUCURSALES con la base de datos de Valija Digital.')
+    parser.add_argument('--aplicar', action='store_true', help='Aplicar las correcciones (por defecto solo reporta)')
+    parser.add_argument('--verificar-paginas', action='store_true',
+                        help='Recontar las páginas de todos los archivos, no solo de los sospechosos')
+    parser.add_argument('--hilos', type=int, default=min(32, (os.cpu_count() or 1) * 4),
+                        help='Hilos para recorrer las carpetas')
+    parser.add_argument('--procesos', type=int, default=os.cpu_count() or 1,
+                        help='Procesos para contar páginas')
+    parser.add_argument('--lote', type=int, default=200, help='Carpetas o documentos por consulta y transacción')
+    args = parser.parse_args()
+
+    # conf.csv y las rutas relativas del .env se resuelven desde la carpeta del servicio.
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    config = ValijaDigitalConfig()
+    Logger(config)
+    database_manager = DatabaseManager(config)
+    database_manager.migrar()
+
+    reconciliador = Reconciliador(config, database_manager, args.hilos, args.procesos,
+                                  max(1, min(args.lote, 900)), args.aplicar, args.verificar_paginas)
+    return 0 if reconciliador.ejecutar() else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,292 @@
+"""
+Reproduce una traza de llegadas grabada con TRACE_FILENAME contra una instancia de ValijaDigitalApp.
+
+Crea PDF sintéticos con los mismos bytes y páginas que los originales dentro de un PATH_ARCHIVOS
+temporal, respetando los tiempos de la traza acelerados por --velocidad, y reporta la latencia
+desde la llegada hasta el registro en la base de datos, el crecimiento de la cola y los errores.
+
+Uso:
+    python replay_valija_digital.py traza.jsonl --velocidad 10
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import pymupdf
+
+from valija_digital import ValijaDigitalApp
+
+ESQUEMA_BASE_DE_DATOS = '''
+    create table documents_documents (
+        id integer primary key autoincrement,
+        name varchar(255) not null,
+        current_path varchar(255) not null,
+        visible bool not null,
+        size integer not null,
+        uploaded_at datetime not null
+    );
+    create table logs_logs (
+        id integer primary key autoincrement,
+        log text not null,
+        documents_id integer,
+        date datetime not null
+    );
+'''
+
+class ContadorErrores(logging.Handler):
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.total = 0
+
+    def emit(self, record):
+        self.total += 1
+
+class ReplayHarness:
+    def __init__(self, eventos, directorio, velocidad, timeout):
+        self.eventos = sorted(eventos, key=lambda evento: evento['t'])
+        self.directorio = directorio
+        self.velocidad = velocidad
+        self.timeout = timeout
+        self.path_archivos = os.path.join(directorio, 'archivos')
+        self.path_sucursales = os.path.join(directorio, 'sucursales')
+        self.path_staging = os.path.join(directorio, 'staging')
+        self.llegadas = {}
+        self.completados = {}
+        self.destinos = {}
+        self.muestras_cola = []
+        self.lock = threading.Lock()
+        self.contador_errores = ContadorErrores()
+        self.app = None
+
+    def preparar(self):
+        for path in [self.path_archivos, self.path_sucursales, self.path_staging]:
+            os.makedirs(path, exist_ok=True)
+
+        # Cada número de serie anonimizado se asigna a una sucursal sintética.
+        tokens = sorted({evento['archivo'].split('-')[0] for evento in self.eventos})
+        path_sucursales_csv = os.path.join(self.directorio, 'equipos_sucursal.csv')
+        with open(path_sucursales_csv, 'w', newline='', encoding='utf-8') as f:
+            f.write('numero_serie,sucursal,carpeta\n')
+            for i, token in enumerate(tokens, start=1):
+                f.write(f'{token},S{i:03},S{i:03} - SUCURSAL {i}\n')
+
+        path_database = os.path.join(self.directorio, 'valija.sqlite3')
+        conn = sqlite3.connect(path_database)
+        conn.executescript(ESQUEMA_BASE_DE_DATOS)
+        conn.close()
+
+        os.environ['PATH_ARCHIVOS'] = self.path_archivos
+        os.environ['PATH_SUCURSALES'] = self.path_sucursales
+        os.environ['SUCURSALES_CSV'] = path_sucursales_csv
+        os.environ['DATABASE_PATH'] = path_database
+        os.environ['LOG_FILENAME'] = os.path.join(self.directorio, 'valija.log')
+        os.environ['TRACE_FILENAME'] = ''
+        if not os.getenv('PROVEEDORES_CSV'):
+            path_proveedores_csv = os.path.join(self.directorio, 'proveedores.csv')
+            open(path_proveedores_csv, 'w', encoding='utf-8').close()
+            os.environ['PROVEEDORES_CSV'] = path_proveedores_csv
+
+        self.app = ValijaDigitalApp()
+        logging.getLogger().addHandler(self.contador_errores)
+        self._instrumentar()
+
+    def _instrumentar(self):
+        """Envuelve los puntos donde un archivo llega a la base de datos para medir su latencia."""
+        file_manager = self.app.file_manager
+        database_manager = self.app.database_manager
+        mueve_archivo = file_manager.mueve_archivo
+        insertar_log = database_manager.insertar_log
+        registrar_union = database_manager.registrar_union
+
+        def mueve_archivo_medido(path_archivo_origen, path_archivo_destino, overwrite=False):
+            path = mueve_archivo(path_archivo_origen, path_archivo_destino, overwrite)
+            if path:
+                with self.lock:
+                    self.destinos[os.path.basename(path)] = os.path.basename(path_archivo_origen)
+            return path
+
+        def insertar_log_medido(log):
+            resultado = insertar_log(log)
+            match = re.match(r'Se creó el documento (.+)\.$', log['log'])
+            if resultado and match:
+                with self.lock:
+                    self._completar(self.destinos.get(match.group(1)))
+            return resultado
+
+        def registrar_union_medido(documento, logs):
+            resultado = registrar_union(documento, logs)
+            if resultado:
+                with self.lock:
+                    for log in logs:
+                        match = re.match(r'Se unió el documento (.+)$', log['log'])
+                        if match:
+                            self._completar(match.group(1))
+            return resultado
+
+        file_manager.mueve_archivo = mueve_archivo_medido
+        database_manager.insertar_log = insertar_log_medido
+        database_manager.registrar_union = registrar_union_medido
+
+    def _completar(self, nombre_archivo):
+        if nombre_archivo in self.llegadas and nombre_archivo not in self.completados:
+            self.completados[nombre_archivo] = time.monotonic()
+
+    def ejecutar(self):
+        hilo_app = threading.Thread(target=self.app.run, daemon=True)
+        hilo_app.start()
+        # Margen para que el observador quede registrado antes de la primera llegada.
+        time.sleep(1)
+
+        detener_muestreo = threading.Event()
+        hilo_muestreo = threading.Thread(target=self._muestrear_cola, args=[detener_muestreo], daemon=True)
+        hilo_muestreo.start()
+
+        inicio = time.monotonic()
+        t0 = self.eventos[0]['t'] if self.eventos else 0
+        for evento in self.eventos:
+            espera = inicio + (evento['t'] - t0) / self.velocidad - time.monotonic()
+            if espera > 0:
+                time.sleep(espera)
+            self._crear_llegada(evento)
+        fin_llegadas = time.monotonic()
+
+        limite = fin_llegadas + self.timeout
+        while time.monotonic() < limite and self._pendientes():
+            time.sleep(0.1)
+        fin = time.monotonic()
+
+        detener_muestreo.set()
+        hilo_muestreo.join()
+        self.app.detener()
+        hilo_app.join(timeout=30)
+        return fin - inicio
+
+    def _crear_llegada(self, evento):
+        carpeta = os.path.join(self.path_archivos, *evento['carpeta'])
+        os.makedirs(carpeta, exist_ok=True)
+        nombre_archivo = self._nombre_unico(evento['archivo'])
+        path_staging = os.path.join(self.path_staging, nombre_archivo)
+        with open(path_staging, 'wb') as f:
+            f.write(self._pdf_sintetico(evento.get('paginas') or 1, evento.get('bytes', 0)))
+        with self.lock:
+            self.llegadas[nombre_archivo] = time.monotonic()
+        # El archivo llega completo, como lo deja el escáner al terminar de escribir.
+        os.replace(path_staging, os.path.join(carpeta, nombre_archivo))
+
+    def _nombre_unico(self, nombre_archivo):
+        if nombre_archivo not in self.llegadas:
+            return nombre_archivo
+        match = re.search(r'\d{4}-\d{2}-\d{2}', nombre_archivo)
+        posicion = match.end() if match else len(os.path.splitext(nombre_archivo)[0])
+        for i in range(1, 100000):
+            candidato = f'{nombre_archivo[:posicion]}R{i}{nombre_archivo[posicion:]}'
+            if candidato not in self.llegadas:
+                return candidato
+
+    def _pdf_sintetico(self, paginas, tamanio):
+        doc = pymupdf.open()
+        for i in range(max(paginas, 1)):
+            page = doc.new_page()
+            page.insert_text((72, 72), f'Pagina sintetica {i + 1}')
+        contenido = doc.tobytes()
+        if tamanio > len(contenido):
+            doc.embfile_add('relleno', os.urandom(tamanio - len(contenido)))
+            contenido = doc.tobytes()
+        doc.close()
+        return contenido
+
+    def _pendientes(self):
+        with self.lock:
+            return len(self.llegadas) - len(self.completados)
+
+    def _muestrear_cola(self, detener):
+        while not detener.wait(0.25):
+            self.muestras_cola.append(self._pendientes())
+
+    def reporte(self, duracion):
+        latencias = sorted(self.completados[nombre] - self.llegadas[nombre] for nombre in self.completados)
+        total = len(self.llegadas)
+        perdidos = total - len(latencias)
+        lineas = [
+            f'Llegadas: {total}  Completadas: {len(latencias)}  Sin registro: {perdidos}',
+            f'Velocidad: {self.velocidad}x  Duración: {duracion:.1f} s  '
+            f'Rendimiento: {len(latencias) / duracion if duracion else 0:.2f} docs/s',
+        ]
+        if latencias:
+            lineas.append('Latencia llegada -> base de datos (s): ' + '  '.join(
+                f'p{p}={percentil(latencias, p):.3f}' for p in (50, 90, 99)) + f'  max={latencias[-1]:.3f}')
+        if self.muestras_cola:
+            lineas.append(f'Cola pendiente: máxima={max(self.muestras_cola)}  final={self.muestras_cola[-1]}')
+        lineas.append(f'Errores registrados: {self.contador_errores.total}  '
+                      f'Tasa de error: {(self.contador_errores.total / total if total else 0):.2%}  '
+                      f'Tasa sin registro: {(perdidos / total if total else 0):.2%}')
+        return '\n'.join(lineas)
+
+def percentil(valores, p):
+    # Percentil por rango más cercano sobre una lista ordenada.
+    indice = max(0, math.ceil(p / 100 * len(valores)) - 1)
+    return valores[indice]
+
+def leer_traza(path_traza):
+    """
+    Lee los eventos de la traza. Cada sesión empieza con un encabezado con su hora de inicio;
+    el 't' de sus eventos se desplaza por esa hora para que las sesiones queden en orden y no
+    se encimen. Cada sesión usa su propia llave, así que sus números de serie anonimizados no se
+    mezclan con los de otras sesiones.
+    """
+    eventos = []
+    inicio_sesion = 0
+    with open(path_traza, encoding='utf-8') as f:
+        for linea in f:
+            if not linea.strip():
+                continue
+            dato = json.loads(linea)
+            if dato.get('sesion'):
+                inicio_sesion = dato['inicio']
+                continue
+            dato['t'] = inicio_sesion + dato['t']
+            eventos.append(dato)
+    return eventos
+
+def main():
+    parser = argparse.ArgumentParser(description='Reproduce una traza de llegadas de Valija Digital.')
+    parser.add_argument('traza', help='Archivo de traza generado con TRACE_FILENAME')
+    parser.add_argument('--velocidad', type=float, default=1.0, help='Factor de aceleración (1 a 100)')
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help='Segundos de espera tras la última llegada para que se registren los documentos')
+    parser.add_argument('--directorio', help='Directorio de trabajo (por defecto uno temporal)')
+    parser.add_argument('--conservar', action='store_true', help='No eliminar el directorio de trabajo al terminar')
+    args = parser.parse_args()
+
+    if not 1 <= args.velocidad <= 100:
+        parser.error('La velocidad debe estar entre 1 y 100')
+
+    eventos = leer_traza(args.traza)
+    if not eventos:
+        print('La traza no contiene llegadas')
+        return 1
+
+    # conf.csv se lee desde el directorio de trabajo del servicio.
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    directorio = args.directorio or tempfile.mkdtemp(prefix='valija_replay_')
+    harness = ReplayHarness(eventos, directorio, args.velocidad, args.timeout)
+    try:
+        harness.preparar()
+        duracion = harness.ejecutar()
+        print(harness.reporte(duracion))
+    finally:
+        if not args.conservar and not args.directorio:
+            shutil.rmtree(directorio, ignore_errors=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
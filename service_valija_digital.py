@@ -23,6 +23,8 @@ class ValijaDigitalService(win32serviceutil.ServiceFramework):
     def SvcStop(self):
         self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
         win32event.SetEvent(self.hWaitStop)
+        if self.app:
+            self.app.detener()
         try:
             import logging
             logging.info('Deteniendo servicio ValijaDigital')
@@ -54,6 +56,11 @@ class ValijaDigitalService(win32serviceutil.ServiceFramework):
             self.app_thread.start()
             
             logging.info('Servicio iniciado correctamente')
+
+            # Reportar cuando termine el calentamiento de dependencias, CSV y carpetas
+            self.ready_thread = threading.Thread(target=self.report_ready)
+            self.ready_thread.daemon = True
+            self.ready_thread.start()
             
             # Esperar hasta que se detenga el servicio
             win32event.WaitForSingleObject(self.hWaitStop, win32event.INFINITE)
@@ -68,6 +75,17 @@ class ValijaDigitalService(win32serviceutil.ServiceFramework):
                 pass
             servicemanager.LogErrorMsg(error_msg)
 
+    def report_ready(self):
+        import logging
+        self.app.calentado.wait()
+        estado = self.app.estado
+        logging.info(f'Servicio ValijaDigital {estado}')
+        if estado == 'listo':
+            servicemanager.LogInfoMsg(f'{self._svc_display_name_}: {estado}')
+        else:
+            servicemanager.LogWarningMsg(f'{self._svc_display_name_}: {estado} '
+                                         f"({', '.join(self.app.fallas_calentamiento)})")
+
 if __name__ == '__main__':
     if len(sys.argv) == 1:
         servicemanager.Initialize()
@@ -1,24 +1,26 @@
 import csv
+import hashlib
+import hmac
+import json
 import logging
 import os
+import queue
 import re
+import secrets
 import shutil
 import sqlite3
 import sys
+import threading
 import time
+from collections import OrderedDict
 from datetime import datetime
 from logging.handlers import RotatingFileHandler
 
-import pymupdf
-import pytesseract
 import pytz
-from PIL import Image
-from PyPDF2 import PdfMerger, PdfReader
-from PyPDF2.errors import PdfReadError
 from dotenv import load_dotenv
-from thefuzz import fuzz
-from watchdog.events import FileSystemEventHandler, DirCreatedEvent, FileCreatedEvent
-from watchdog.observers import Observer
+
+# pymupdf, pytesseract, PIL, PyPDF2, thefuzz y watchdog se importan al usarse por primera vez
+# (o durante ValijaDigitalApp.calentar) para que el servicio arranque sin esperar su carga.
 
 load_dotenv()
 
@@ -31,6 +33,7 @@ class ValijaDigitalConfig:
         self.TESSERACT_PATH = os.getenv('TESSERACT_PATH')
         self.DATABASE_PATH = os.getenv('DATABASE_PATH')
         self.LOG_FILENAME = os.getenv('LOG_FILENAME')
+        self.TRACE_FILENAME = os.getenv('TRACE_FILENAME')
         
         self.MESES = {
             '01': 'ENERO', '02': 'FEBRERO', '03': 'MARZO', '04': 'ABRIL',
@@ -44,8 +47,24 @@ class ValijaDigitalConfig:
         except ValueError:
             self.LOG_SIZE_IN_BYTES = 1000000
             self.NUMBER_OF_LOGS = 3
-            
-        pytesseract.pytesseract.tesseract_cmd = self.TESSERACT_PATH
+
+        # Ventana (segundos) para agrupar las partes de un mismo documento de GASTOS. 0 la desactiva.
+        try:
+            self.GASTOS_VENTANA_AGRUPACION = float(os.getenv('GASTOS_VENTANA_AGRUPACION', 2))
+        except ValueError:
+            self.GASTOS_VENTANA_AGRUPACION = 2.0
+
+        # Reescritura en segundo plano de los PDF movidos o unidos para reducir su tamaño en disco.
+        self.OPTIMIZAR_PDF = os.getenv('OPTIMIZAR_PDF', '').strip().lower() in ('1', 'true', 'si', 'sí')
+        try:
+            self.OPTIMIZAR_PDF_DPI = int(os.getenv('OPTIMIZAR_PDF_DPI', 0))
+        except ValueError:
+            self.OPTIMIZAR_PDF_DPI = 0
+
+        try:
+            self.DOCUMENTOS_CACHE_SIZE = int(os.getenv('DOCUMENTOS_CACHE_SIZE', 1024))
+        except ValueError:
+            self.DOCUMENTOS_CACHE_SIZE = 1024
 
 class Logger:
     def __init__(self, config):
@@ -69,11 +88,84 @@ class Logger:
         self.logger.addHandler(file_handler)
         self.logger.addHandler(stdout_handler)
 
+class DocumentoCache:
+    """Mapa LRU acotado de (nombre, carpeta) al id y tamaño del documento en la base de datos."""
+    def __init__(self, capacidad):
+        self.capacidad = capacidad
+        self.documentos = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, nombre_documento, path_documento):
+        with self.lock:
+            documento = self.documentos.get((nombre_documento, path_documento))
+            if documento is None:
+                return None
+            self.documentos.move_to_end((nombre_documento, path_documento))
+            return dict(documento)
+
+    def guardar(self, documento):
+        if self.capacidad <= 0 or not documento:
+            return
+        clave = (documento['name'], documento['current_path'])
+        with self.lock:
+            self.documentos[clave] = {
+                'id': documento['id'],
+                'name': documento['name'],
+                'current_path': documento['current_path'],
+                'size': documento.get('size'),
+            }
+            self.documentos.move_to_end(clave)
+            while len(self.documentos) > self.capacidad:
+                self.documentos.popitem(last=False)
+
+    def descartar(self, nombre_documento, path_documento):
+        with self.lock:
+            self.documentos.pop((nombre_documento, path_documento), None)
+
 class DatabaseManager:
+    # (tabla, columnas, nombre) de los índices que el servicio necesita.
+    INDICES = [
+        ('documents_documents', ('current_path', 'name'), 'documents_documents_current_path_name_idx'),
+    ]
+
     def __init__(self, config):
         self.database_path = config.DATABASE_PATH
-        
+        self.cache_documentos = DocumentoCache(config.DOCUMENTOS_CACHE_SIZE)
+
+    def migrar(self):
+        """Verifica que existan los índices de INDICES y crea los que falten. Regresa False si falla."""
+        resultado = False
+        conn = None
+        try:
+            conn = sqlite3.connect(self.database_path)
+            cursor_obj = conn.cursor()
+            for tabla, columnas, nombre in self.INDICES:
+                if self._tiene_indice(cursor_obj, tabla, columnas):
+                    continue
+                logging.info(f'Creando índice {nombre} en {tabla}')
+                cursor_obj.execute(f'create index if not exists {nombre} on {tabla} ({", ".join(columnas)})')
+                conn.commit()
+            resultado = True
+        except sqlite3.Error as error:
+            logging.error(error)
+        finally:
+            if conn:
+                conn.close()
+        return resultado
+
+    def _tiene_indice(self, cursor_obj, tabla, columnas):
+        indices = cursor_obj.execute(f'pragma index_list({tabla})').fetchall()
+        for indice in indices:
+            columnas_indice = [row[2] for row in cursor_obj.execute(f'pragma index_info("{indice[1]}")').fetchall()]
+            # Para búsquedas por igualdad en todas las columnas el orden del índice no importa.
+            if set(columnas_indice[:len(columnas)]) == set(columnas):
+                return True
+        return False
+
     def get_documento(self, nombre_documento, path_documento):
+        documento = self.cache_documentos.get(nombre_documento, path_documento)
+        if documento:
+            return documento
         documento = {}
         try:
             conn = sqlite3.connect(self.database_path)
@@ -87,6 +179,7 @@ class DatabaseManager:
                     'name': result_documento[1],
                     'current_path': result_documento[2]
                 }
+                self.cache_documentos.guardar(documento)
         except sqlite3.Error as error:
             logging.error(error)
         finally:
@@ -117,63 +210,204 @@ class DatabaseManager:
                     'uploaded_at': result_documento[5]
                 }
             conn.commit()
+            self.cache_documentos.guardar(documento_dic)
         except sqlite3.Error as error:
             logging.error(error)
         finally:
             conn.close()
         return documento_dic
 
-    def update_size(self, documento):
-        documento_dic = {}
+    def insertar_log(self, log):
+        resultado = False
+        datetime_now = datetime.now(pytz.timezone('UTC'))
         try:
             conn = sqlite3.connect(self.database_path)
-            statement = '''
-                        update documents_documents 
-                        set size = $1
-                        where id = $2
-                        returning id, name, current_path, visible, size, uploaded_at
-                    '''
+            statement = '''insert into logs_logs (log, documents_id,date) values ($1, $2, $3)'''
             cursor_obj = conn.cursor()
-            cursor_obj.execute(statement, [documento['size'], documento['id']])
-            result_documento = cursor_obj.fetchone()
-            if result_documento:
-                documento_dic = {
-                    'id': result_documento[0],
-                    'name': result_documento[1],
-                    'current_path': result_documento[2],
-                    'visible': result_documento[3],
-                    'size': result_documento[4],
-                    'uploaded_at': result_documento[5]
-                }
+            cursor_obj.execute(statement, [log['log'], log['documents'], datetime_now.strftime('%Y-%m-%d %H:%M:%S')])
             conn.commit()
+            if cursor_obj.rowcount == 1:
+                resultado = True
         except sqlite3.Error as error:
             logging.error(error)
         finally:
             conn.close()
-        return documento_dic
+        return resultado
 
-    def insertar_log(self, log):
+    def registrar_union(self, documento, logs):
+        """Actualiza el tamaño del documento e inserta sus logs en una sola transacción."""
         resultado = False
         datetime_now = datetime.now(pytz.timezone('UTC'))
+        fecha = datetime_now.strftime('%Y-%m-%d %H:%M:%S')
+        conn = None
         try:
             conn = sqlite3.connect(self.database_path)
-            statement = '''insert into logs_logs (log, documents_id,date) values ($1, $2, $3)'''
             cursor_obj = conn.cursor()
-            cursor_obj.execute(statement, [log['log'], log['documents'], datetime_now.strftime('%Y-%m-%d %H:%M:%S')])
+            cursor_obj.execute('''update documents_documents set size = $1 where id = $2''',
+                               [documento['size'], documento['id']])
+            if cursor_obj.rowcount != 1:
+                # El id en caché ya no existe en la base de datos.
+                conn.rollback()
+                self.cache_documentos.descartar(documento['name'], documento['current_path'])
+                logging.error(f"No se encontró el documento {documento['name']} en la base de datos")
+                return resultado
+            cursor_obj.executemany('''insert into logs_logs (log, documents_id,date) values ($1, $2, $3)''',
+                                   [[log['log'], log['documents'], fecha] for log in logs])
             conn.commit()
-            if cursor_obj.rowcount == 1:
-                resultado = True
+            self.cache_documentos.guardar(documento)
+            resultado = True
         except sqlite3.Error as error:
+            if conn:
+                conn.rollback()
             logging.error(error)
         finally:
-            conn.close()
+            if conn:
+                conn.close()
+        return resultado
+
+    def get_carpetas_documentos(self):
+        """Regresa las carpetas distintas registradas en documents_documents, o None si falla la consulta."""
+        conn = None
+        try:
+            conn = sqlite3.connect(self.database_path)
+            cursor_obj = conn.cursor()
+            cursor_obj.execute('''select distinct current_path from documents_documents''')
+            return [row[0] for row in cursor_obj.fetchall()]
+        except sqlite3.Error as error:
+            logging.error(error)
+            return None
+        finally:
+            if conn:
+                conn.close()
+
+    def get_documentos_por_carpeta(self, carpetas):
+        """
+        Regresa {carpeta: {nombre: documento}} para las carpetas indicadas, incluyendo la fecha
+        del último log (o de carga) de cada documento. Regresa None si falla la consulta.
+        """
+        documentos = {}
+        if not carpetas:
+            return documentos
+        conn = None
+        try:
+            conn = sqlite3.connect(self.database_path)
+            statement = f'''
+                        select d.id, d.name, d.current_path, d.size, coalesce(max(l.date), d.uploaded_at)
+                        from documents_documents d left join logs_logs l on l.documents_id = d.id
+                        where d.current_path in ({', '.join('?' * len(carpetas))})
+                        group by d.id
+                    '''
+            cursor_obj = conn.cursor()
+            cursor_obj.execute(statement, list(carpetas))
+            for row in cursor_obj:
+                documentos.setdefault(row[2], {})[row[1]] = {
+                    'id': row[0],
+                    'name': row[1],
+                    'current_path': row[2],
+                    'size': row[3],
+                    'ultima_modificacion': row[4]
+                }
+            return documentos
+        except sqlite3.Error as error:
+            logging.error(error)
+            return None
+        finally:
+            if conn:
+                conn.close()
+
+    def reparar_documentos(self, nuevos=(), tamanios=(), reubicados=(), verificados=()):
+        """
+        Aplica en una sola transacción las correcciones de la reconciliación: inserta documentos
+        faltantes, corrige tamaños y reubica documentos, con un log por cada corrección. Los
+        documentos verificados solo reciben un log que marca su número de páginas como revisado.
+        """
+        resultado = False
+        datetime_now = datetime.now(pytz.timezone('UTC'))
+        fecha = datetime_now.strftime('%Y-%m-%d %H:%M:%S')
+        statement_log = '''insert into logs_logs (log, documents_id,date) values ($1, $2, $3)'''
+        conn = None
+        try:
+            conn = sqlite3.connect(self.database_path)
+            cursor_obj = conn.cursor()
+            logs = []
+            for documento in nuevos:
+                # No se inserta si el servicio ya registró el documento mientras tanto.
+                cursor_obj.execute('''
+                        insert into documents_documents (name, current_path, visible, size, uploaded_at) 
+                        select $1, $2, $3, $4, $5
+                        where not exists (select 1 from documents_documents d where d.name = $1 and d.current_path = $2)
+                        returning id
+                    ''', [documento['name'], documento['current_path'], True, documento['size'], fecha])
+                result_documento = cursor_obj.fetchone()
+                if not result_documento:
+                    continue
+                documento_id = result_documento[0]
+                logs.append([f"Se creó el documento {documento['name']} por reconciliación.", documento_id, fecha])
+            cursor_obj.executemany('''update documents_documents set size = $1 where id = $2''',
+                                   [[documento['size'], documento['id']] for documento in tamanios])
+            logs.extend([f"Se corrigió el número de páginas a {documento['size']} por reconciliación.",
+                         documento['id'], fecha] for documento in tamanios)
+            cursor_obj.executemany('''update documents_documents set current_path = $1, size = $2 where id = $3''',
+                                   [[documento['current_path'], documento['size'], documento['id']]
+                                    for documento in reubicados])
+            logs.extend([f"Se reubicó el documento en {documento['current_path']} por reconciliación.",
+                         documento['id'], fecha] for documento in reubicados)
+            logs.extend([f"Se verificó el número de páginas ({documento['size']}) por reconciliación.",
+                         documento['id'], fecha] for documento in verificados)
+            cursor_obj.executemany(statement_log, logs)
+            conn.commit()
+            resultado = True
+        except sqlite3.Error as error:
+            if conn:
+                conn.rollback()
+            logging.error(error)
+        finally:
+            if conn:
+                conn.close()
+        for documento in tamanios:
+            self.cache_documentos.descartar(documento['name'], documento['current_path'])
+        for documento in reubicados:
+            self.cache_documentos.descartar(documento['name'], documento['path_anterior'])
         return resultado
 
 class CSVManager:
     def __init__(self, config):
         self.config = config
-        
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def precargar(self):
+        self.get_conf_csv()
+        self.get_proveedores_csv()
+        self._get_sucursales()
+
+    def _cacheado(self, path, cargar, por_defecto):
+        """
+        Regresa el contenido ya leído del CSV mientras el archivo no se modifique. Los cargadores
+        regresan None si la lectura falla; en ese caso se regresa por_defecto y no se guarda en caché,
+        para volver a intentar en la siguiente llamada.
+        """
+        try:
+            mtime = os.path.getmtime(path)
+        except (OSError, TypeError):
+            mtime = None
+        if mtime is not None:
+            with self.lock:
+                entrada = self.cache.get(path)
+                if entrada and entrada[0] == mtime:
+                    return entrada[1]
+        valor = cargar()
+        if valor is None:
+            return por_defecto
+        if mtime is not None:
+            with self.lock:
+                self.cache[path] = (mtime, valor)
+        return valor
+
     def get_conf_csv(self):
+        return self._cacheado('conf.csv', self._cargar_conf_csv, {})
+
+    def _cargar_conf_csv(self):
         conf = {}
         try:
             with open('conf.csv', newline='') as csvfile:
@@ -183,11 +417,14 @@ class CSVManager:
             return conf
         except FileNotFoundError:
             logging.error('No se encontro el archivo conf.csv')
-            return {}
         except Exception as e:
             logging.error(e)
+        return None
 
     def get_proveedores_csv(self):
+        return self._cacheado(self.config.PROVEEDORES_CSV, self._cargar_proveedores_csv, [])
+
+    def _cargar_proveedores_csv(self):
         proveedores = []
         try:
             with open(self.config.PROVEEDORES_CSV, newline='', encoding='utf-8') as csvfile:
@@ -201,38 +438,64 @@ class CSVManager:
                         proveedores.append(dict_proveedor)
                 except IndexError:
                     pass
-                except Exception as e:
-                    logging.error(e)
-                    pass
             return proveedores
         except FileNotFoundError:
             logging.error('No se encontro el archivo proveedores.csv')
-            return []
         except Exception as e:
             logging.error(e)
-            return []
+        return None
 
     def get_sucursal_csv(self, numero_serie):
+        return self._get_sucursales().get(numero_serie, (None, None))
+
+    def _get_sucursales(self):
+        return self._cacheado(self.config.SUCURSALES_CSV, self._cargar_sucursales_csv, {})
+
+    def _cargar_sucursales_csv(self):
+        sucursales = {}
         try:
             with open(self.config.SUCURSALES_CSV, newline='', encoding='utf-8') as csvfile:
                 csv_sucurlsales = csv.reader(csvfile, skipinitialspace=True)
                 for row in csv_sucurlsales:
-                    if row[0] == numero_serie:
-                        return row[1], row[2]
-                return None, None
+                    if len(row) >= 3:
+                        sucursales.setdefault(row[0], (row[1], row[2]))
+            return sucursales
         except FileNotFoundError:
             logging.error('No se encontró el archivo equipos_sucursal.csv')
-            return None, None
         except Exception as e:
             logging.error(f'Error al leer el archivo equipos_sucursal.csv: {e}')
-            return None, None
+        return None
 
 class PDFProcessor:
     def __init__(self, config, csv_manager):
         self.config = config
         self.csv_manager = csv_manager
+        self.lock_escritura = threading.Lock()
+
+    def precargar(self):
+        # Importar aquí deja los módulos en sys.modules para las siguientes llamadas.
+        import pymupdf
+        import PIL.Image
+        import PyPDF2
+        import thefuzz.fuzz
+        try:
+            # Ejecutar tesseract una vez deja el binario y sus datos en la caché del sistema.
+            version = self._tesseract().get_tesseract_version()
+            logging.debug(f'Tesseract {version} listo')
+            return True
+        except Exception as e:
+            logging.error(f'No se pudo inicializar tesseract: {e}')
+            return False
+
+    def _tesseract(self):
+        import pytesseract
+        pytesseract.pytesseract.tesseract_cmd = self.config.TESSERACT_PATH
+        return pytesseract
 
     def get_size(self, path_documento):
+        from PyPDF2 import PdfReader
+        from PyPDF2.errors import PdfReadError
+
         try:
             with open(path_documento, "rb") as f:
                 try:
@@ -252,6 +515,9 @@ class PDFProcessor:
         if not (os.path.exists(path_documento) and os.path.isfile(path_documento) and 'COMPLETO' not in path_documento):
             return None
 
+        import pymupdf
+        from PIL import Image
+
         logging.debug(f'Obteniendo nombre de proveedor')
         conf_similitud = 75
         try:
@@ -280,6 +546,7 @@ class PDFProcessor:
         return self._extract_proveedor_name(contrarecibo, conf_similitud)
 
     def _find_contrarecibo(self, paginas_pdf):
+        pytesseract = self._tesseract()
         for pagina in paginas_pdf:
             pagina, imagen_encabezado = self._get_encabezado(pagina)
             texto_encabezado = pytesseract.image_to_data(imagen_encabezado, output_type=pytesseract.Output.DICT,
@@ -298,6 +565,7 @@ class PDFProcessor:
         return imagen, imagen_encabezado
 
     def _extract_proveedor_name(self, contrarecibo, conf_similitud):
+        pytesseract = self._tesseract()
         seccion_contrarecibo = self._get_seccion_contrarecibo(contrarecibo)
         texto_contrarecibo = pytesseract.image_to_data(seccion_contrarecibo, output_type=pytesseract.Output.DICT,
                                                        lang='eng',
@@ -332,6 +600,8 @@ class PDFProcessor:
         return imagen.crop((coordenadas[0] - 5, coordenadas[1] - 5, int(imagen.size[0] / 2), coordenadas[1] + coordenadas[3] + 5))
 
     def _match_proveedor(self, datos_proveedor, conf_similitud):
+        from thefuzz import fuzz
+
         datos_proveedor = [x for x in datos_proveedor if len(x) > 0]
         indice_nombre_proveedor = -1
         
@@ -367,20 +637,145 @@ class PDFProcessor:
                     return dato
         return None
 
-    def unir_documentos(self, path_destino, path_nuevo_archivo):
-        logging.info('Uniendo documentos')
-        resultado = False
+    def unir_varios_documentos(self, path_destino, paths_nuevos_archivos):
+        """
+        Agrega los archivos al final del destino con una sola escritura. Los archivos que no se
+        pueden leer se omiten; regresa la lista de los que sí se unieron.
+        """
+        from PyPDF2 import PdfMerger
+
+        logging.info(f'Uniendo {len(paths_nuevos_archivos)} documento(s)')
+        unidos = []
+        reintentar_por_separado = []
+        # PdfWriter abre la salida antes de leer las partes; escribir directo sobre el destino lo
+        # truncaría si una parte falla durante la escritura.
+        path_temporal = f'{path_destino}.union.tmp'
         merger = PdfMerger()
         try:
-            merger.append(path_destino)
-            merger.append(path_nuevo_archivo)
-            merger.write(path_destino)
-            resultado = True
+            with self.lock_escritura:
+                merger.append(path_destino)
+                for path_nuevo_archivo in paths_nuevos_archivos:
+                    try:
+                        merger.append(path_nuevo_archivo)
+                        unidos.append(path_nuevo_archivo)
+                    except Exception as e:
+                        logging.error(f'Error al unir el documento {path_nuevo_archivo}: {e}')
+                if unidos:
+                    merger.write(path_temporal)
+                    os.replace(path_temporal, path_destino)
         except Exception as e:
             logging.error(f'Error al unir el documento {e}')
+            if len(unidos) > 1:
+                reintentar_por_separado = unidos
+            unidos = []
         finally:
             merger.close()
-        return resultado
+            if os.path.exists(path_temporal):
+                os.remove(path_temporal)
+
+        if reintentar_por_separado:
+            # No se sabe qué parte hizo fallar la escritura; se unen una por una para conservar las demás.
+            logging.info('Uniendo las partes por separado')
+            for path_nuevo_archivo in reintentar_por_separado:
+                unidos.extend(self.unir_varios_documentos(path_destino, [path_nuevo_archivo]))
+        return unidos
+
+class PDFOptimizer:
+    """
+    Reescribe los PDF ya archivados con recolección de objetos, compresión de streams y
+    deduplicación. Trabaja en un hilo propio para no retrasar el procesamiento de archivos nuevos.
+    """
+    def __init__(self, config, pdf_processor):
+        self.dpi = config.OPTIMIZAR_PDF_DPI
+        self.pdf_processor = pdf_processor
+        self.cola = queue.Queue()
+        self.pendientes = set()
+        self.lock = threading.Lock()
+        self.hilo = threading.Thread(target=self._trabajar, daemon=True)
+        self.hilo.start()
+
+    def encolar(self, path_documento):
+        with self.lock:
+            if path_documento in self.pendientes:
+                return
+            self.pendientes.add(path_documento)
+        self.cola.put(path_documento)
+
+    def detener(self, timeout=10):
+        """Descarta los documentos pendientes y espera, como máximo timeout segundos, al que está en proceso."""
+        with self.lock:
+            self.pendientes.clear()
+            while True:
+                try:
+                    self.cola.get_nowait()
+                except queue.Empty:
+                    break
+            self.cola.put(None)
+        self.hilo.join(timeout)
+
+    def _trabajar(self):
+        while True:
+            path_documento = self.cola.get()
+            if path_documento is None:
+                break
+            with self.lock:
+                self.pendientes.discard(path_documento)
+            try:
+                self.optimizar(path_documento)
+            except Exception as e:
+                logging.error(f'Error al optimizar el documento {path_documento}: {e}')
+
+    def optimizar(self, path_documento):
+        """Reemplaza el documento por su versión optimizada y regresa los bytes ahorrados."""
+        import pymupdf
+
+        path_temporal = f'{path_documento}.tmp'
+        try:
+            stat_original = os.stat(path_documento)
+        except FileNotFoundError:
+            return 0
+        tamanio_original = stat_original.st_size
+
+        # La reescritura se hace sin el lock de escritura para no detener las uniones; el lock
+        # solo se toma para comprobar que el original no cambió y reemplazarlo.
+        try:
+            num_paginas = self.pdf_processor.get_size(path_documento)
+            doc = pymupdf.open(path_documento)
+            try:
+                if self.dpi > 0:
+                    # Solo se reducen las imágenes que exceden claramente la resolución configurada.
+                    doc.rewrite_images(dpi_threshold=int(self.dpi * 1.5), dpi_target=self.dpi)
+                doc.save(path_temporal, garbage=4, deflate=True, deflate_images=True,
+                         deflate_fonts=True, clean=True)
+            finally:
+                doc.close()
+
+            tamanio_nuevo = os.path.getsize(path_temporal)
+            if self.pdf_processor.get_size(path_temporal) != num_paginas:
+                logging.error(f'La versión optimizada de {path_documento} no conserva el número de páginas')
+                return 0
+            if tamanio_nuevo >= tamanio_original:
+                logging.debug(f'No se obtuvo ahorro al optimizar {path_documento}')
+                return 0
+
+            with self.pdf_processor.lock_escritura:
+                try:
+                    stat_actual = os.stat(path_documento)
+                except FileNotFoundError:
+                    return 0
+                if (stat_actual.st_mtime_ns, stat_actual.st_size) != (stat_original.st_mtime_ns, tamanio_original):
+                    # Se unió otro documento mientras tanto; la unión vuelve a encolar el archivo.
+                    logging.debug(f'El documento {path_documento} cambió durante la optimización')
+                    return 0
+                os.replace(path_temporal, path_documento)
+        finally:
+            if os.path.exists(path_temporal):
+                os.remove(path_temporal)
+
+        ahorro = tamanio_original - tamanio_nuevo
+        logging.info(f'Se optimizó el documento {path_documento}: {ahorro} bytes ahorrados '
+                     f'({tamanio_original} -> {tamanio_nuevo})')
+        return ahorro
 
 class FileManager:
     def __init__(self, config):
@@ -427,6 +822,28 @@ class PathManager:
         self.config = config
         self.csv_manager = csv_manager
         self.pdf_processor = pdf_processor
+        self.directorios_existentes = set()
+        self.lock = threading.Lock()
+
+    def precargar_directorios(self, profundidad=5):
+        """Registra las carpetas existentes de PATH_SUCURSALES (sucursal/flujo/año/mes/tipo)."""
+        pendientes = [(self.config.PATH_SUCURSALES, 0)]
+        encontrados = set()
+        while pendientes:
+            path, nivel = pendientes.pop()
+            encontrados.add(path)
+            if nivel >= profundidad:
+                continue
+            try:
+                with os.scandir(path) as entradas:
+                    for entrada in entradas:
+                        if entrada.is_dir(follow_symlinks=False):
+                            pendientes.append((entrada.path, nivel + 1))
+            except OSError as e:
+                logging.error(f'Error al leer la carpeta {path}: {e}')
+        with self.lock:
+            self.directorios_existentes.update(encontrados)
+        logging.debug(f'Se registraron {len(encontrados)} carpetas')
 
     def crea_paths(self, path_archivo, nombre_archivo):
         path_carpeta = path_archivo.replace(self.config.PATH_ARCHIVOS, '')
@@ -489,6 +906,8 @@ class PathManager:
 
     def _crear_directorios(self, paths):
         for path in paths:
+            if path in self.directorios_existentes:
+                continue
             if not os.path.exists(path):
                 try:
                     os.mkdir(path)
@@ -496,6 +915,28 @@ class PathManager:
                 except (PermissionError, FileExistsError) as e:
                     logging.error(f'Error al crear carpeta {path}: {e}')
                     raise ValueError
+            with self.lock:
+                self.directorios_existentes.add(path)
+
+    def recrear_directorio(self, path):
+        """
+        Olvida la carpeta y sus superiores de la caché y la vuelve a crear. Se usa cuando una carpeta
+        registrada se eliminó o renombró fuera del servicio.
+        """
+        with self.lock:
+            actual = path
+            while os.path.dirname(actual) != actual:
+                self.directorios_existentes.discard(actual)
+                actual = os.path.dirname(actual)
+        try:
+            os.makedirs(path, exist_ok=True)
+            logging.info(f'Se volvió a crear la carpeta {path}')
+        except OSError as e:
+            logging.error(f'Error al crear carpeta {path}: {e}')
+            return False
+        with self.lock:
+            self.directorios_existentes.add(path)
+        return True
 
     def _procesar_flujo(self, flujo, path_archivo, nombre_archivo, fecha, sucursal, 
                        path_mes, separador_nombre, complemento_nombre_completo, path_carpeta):
@@ -581,8 +1022,155 @@ class DocumentProcessor:
             logging.error(f'Error al insertar el documento en la base de datos')
             return False
 
-class FileObserver(FileSystemEventHandler):
-    def __init__(self, config, csv_manager, pdf_processor, file_manager, path_manager, document_processor, database_manager):
+class GastosCoalescer:
+    """
+    Agrupa las partes incompletas de GASTOS (_NNNNNN.pdf) que van al mismo documento destino.
+    Las partes se retienen durante la ventana configurada y después se procesan juntas.
+    """
+    def __init__(self, ventana, procesar_partes):
+        self.ventana = ventana
+        self.procesar_partes = procesar_partes
+        self.pendientes = {}
+        self.timers = {}
+        self.lock = threading.Lock()
+        self.lock_proceso = threading.Lock()
+
+    def agregar(self, path_destino, path_parte):
+        with self.lock:
+            self.pendientes.setdefault(path_destino, []).append(path_parte)
+            if path_destino not in self.timers:
+                timer = threading.Timer(self.ventana, self._vaciar_destino, args=[path_destino])
+                timer.daemon = True
+                self.timers[path_destino] = timer
+                timer.start()
+
+    def vaciar(self):
+        with self.lock:
+            destinos = list(self.pendientes.keys())
+            for timer in self.timers.values():
+                timer.cancel()
+        for path_destino in destinos:
+            self._vaciar_destino(path_destino)
+
+    def _vaciar_destino(self, path_destino):
+        # Un solo proceso a la vez para no escribir el mismo destino desde dos hilos.
+        with self.lock_proceso:
+            with self.lock:
+                partes = self.pendientes.pop(path_destino, [])
+                self.timers.pop(path_destino, None)
+            if not partes:
+                return
+            partes.sort(key=self._orden_parte)
+            try:
+                self.procesar_partes(path_destino, partes)
+            except Exception as e:
+                logging.error(f'Error al procesar las partes de {path_destino}: {e}')
+
+    @staticmethod
+    def _orden_parte(path_parte):
+        match = re.search(r'_(\d{6})\.pdf$', os.path.basename(path_parte), re.IGNORECASE)
+        return (int(match.group(1)) if match else -1, path_parte)
+
+class TraceRecorder:
+    """
+    Registra en un archivo JSON por línea cada llegada a PATH_ARCHIVOS, sin datos identificables:
+    tiempo relativo, forma de la carpeta, forma del nombre, bytes y páginas.
+    La traza se reproduce con replay_valija_digital.py.
+
+    En el hilo de watchdog solo se toma el tiempo, el tamaño y un enlace duro al archivo; el conteo
+    de páginas y la escritura se hacen en un hilo propio para no retrasar el procesamiento.
+    """
+    def __init__(self, config, pdf_processor):
+        self.path_traza = config.TRACE_FILENAME
+        self.path_archivos = config.PATH_ARCHIVOS
+        self.path_enlaces = f'{config.TRACE_FILENAME}.pendientes'
+        self.pdf_processor = pdf_processor
+        # Llave aleatoria por sesión: los números de serie no se pueden recuperar comparando hashes.
+        # Los tokens solo son consistentes dentro de una sesión.
+        self.llave = secrets.token_bytes(32)
+        self.inicio = time.monotonic()
+        self.inicio_epoch = time.time()
+        self.contador = 0
+        self.cola = queue.Queue()
+        self.hilo = threading.Thread(target=self._trabajar, daemon=True)
+        self.hilo.start()
+
+    def registrar(self, path_archivo):
+        try:
+            t = round(time.monotonic() - self.inicio, 3)
+            tamanio = os.path.getsize(path_archivo)
+            path_enlace = None
+            if os.path.splitext(path_archivo)[1].lower() == '.pdf':
+                path_enlace = self._enlazar(path_archivo)
+            self.cola.put((t, path_archivo, tamanio, path_enlace))
+        except Exception as e:
+            logging.error(f'Error al registrar la llegada en la traza: {e}')
+
+    def detener(self, timeout=10):
+        self.cola.put(None)
+        self.hilo.join(timeout)
+
+    def _enlazar(self, path_archivo):
+        # El enlace conserva el contenido aunque el archivo original se mueva o se elimine al unirse.
+        self.contador += 1
+        path_enlace = os.path.join(self.path_enlaces, f'{self.contador:08}.pdf')
+        try:
+            os.makedirs(self.path_enlaces, exist_ok=True)
+            os.link(path_archivo, path_enlace)
+            return path_enlace
+        except OSError as e:
+            logging.debug(f'No se pudo enlazar {path_archivo} para la traza: {e}')
+            return None
+
+    def _trabajar(self):
+        # Cada arranque agrega un encabezado de sesión; los tiempos 't' que siguen son relativos a él.
+        try:
+            with open(self.path_traza, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'sesion': True, 'inicio': round(self.inicio_epoch, 3)}) + '\n')
+        except Exception as e:
+            logging.error(f'Error al registrar la sesión en la traza: {e}')
+        while True:
+            elemento = self.cola.get()
+            if elemento is None:
+                break
+            t, path_archivo, tamanio, path_enlace = elemento
+            try:
+                ruta_archivo, nombre_archivo = os.path.split(path_archivo)
+                evento = {
+                    't': t,
+                    'carpeta': self._anonimizar_carpeta(ruta_archivo),
+                    'archivo': self._anonimizar_nombre(nombre_archivo),
+                    'bytes': tamanio,
+                    'paginas': self.pdf_processor.get_size(path_enlace) if path_enlace else None,
+                }
+                with open(self.path_traza, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(evento, ensure_ascii=False) + '\n')
+            except Exception as e:
+                logging.error(f'Error al registrar la llegada en la traza: {e}')
+            finally:
+                if path_enlace and os.path.exists(path_enlace):
+                    os.remove(path_enlace)
+
+    def _anonimizar_carpeta(self, ruta_archivo):
+        carpetas = os.path.relpath(ruta_archivo, self.path_archivos).split(os.sep)
+        # Solo el flujo de la carpeta raíz se usa para enrutar; el resto del nombre se descarta.
+        partes_raiz = carpetas[0].split('-')
+        carpetas[0] = '-'.join(['X'] + partes_raiz[1:])
+        return carpetas
+
+    def _anonimizar_nombre(self, nombre_archivo):
+        nombre, extension = os.path.splitext(nombre_archivo)
+        match = re.search(r'\d{4}-\d{2}-\d{2}', nombre)
+        if not match:
+            return re.sub(r'[^\W\d_]', 'X', nombre) + extension
+        numero_serie = nombre.split('-')[0]
+        token = hmac.new(self.llave, numero_serie.encode('utf-8'), hashlib.sha256).hexdigest()[:10].upper()
+        resto = re.sub(r'[^\W\d_]', 'X', nombre[match.end():])
+        return f'{token}-{match.group(0)}{resto}{extension}'
+
+class FileObserver:
+    def __init__(self, config, csv_manager, pdf_processor, file_manager, path_manager, document_processor, database_manager,
+                 pdf_optimizer=None, trace_recorder=None):
         self.config = config
         self.csv_manager = csv_manager
         self.pdf_processor = pdf_processor
@@ -590,10 +1178,22 @@ class FileObserver(FileSystemEventHandler):
         self.path_manager = path_manager
         self.document_processor = document_processor
         self.database_manager = database_manager
+        self.pdf_optimizer = pdf_optimizer
+        self.trace_recorder = trace_recorder
+        self.gastos_coalescer = None
+        if config.GASTOS_VENTANA_AGRUPACION > 0:
+            self.gastos_coalescer = GastosCoalescer(config.GASTOS_VENTANA_AGRUPACION, self._process_gastos_parts)
+
+    def dispatch(self, event):
+        # El Observer de watchdog solo necesita dispatch(); así no se importa watchdog al cargar el módulo.
+        if event.event_type == 'created':
+            self.on_created(event)
 
     def on_created(self, event):
-        if isinstance(event, FileCreatedEvent):
+        if not event.is_directory:
             if self.config.PATH_SUCURSALES not in event.src_path:
+                if self.trace_recorder:
+                    self.trace_recorder.registrar(event.src_path)
                 self._process_file(event.src_path)
 
     def _process_file(self, path_nuevo_archivo):
@@ -626,7 +1226,7 @@ class FileObserver(FileSystemEventHandler):
 
     def _process_simple_file(self, path_nuevo_archivo, nuevo_path, nombre):
         path_destino = os.path.join(nuevo_path, nombre)
-        path = self.file_manager.mueve_archivo(path_nuevo_archivo, path_destino, overwrite=False)
+        path = self._mueve_archivo(path_nuevo_archivo, path_destino, overwrite=False)
         if path:
             current_path, name = os.path.split(path)
             doc = {
@@ -635,6 +1235,20 @@ class FileObserver(FileSystemEventHandler):
                 'visible': True,
             }
             self.document_processor.insertar_en_base_de_datos(doc)
+            self._optimizar(path)
+
+    def _mueve_archivo(self, path_archivo_origen, path_archivo_destino, overwrite):
+        path = self.file_manager.mueve_archivo(path_archivo_origen, path_archivo_destino, overwrite=overwrite)
+        carpeta_destino = os.path.dirname(path_archivo_destino)
+        if not path and os.path.exists(path_archivo_origen) and not os.path.isdir(carpeta_destino):
+            # La carpeta estaba en la caché de PathManager pero se eliminó fuera del servicio.
+            if self.path_manager.recrear_directorio(carpeta_destino):
+                path = self.file_manager.mueve_archivo(path_archivo_origen, path_archivo_destino, overwrite=overwrite)
+        return path
+
+    def _optimizar(self, path_documento):
+        if self.pdf_optimizer:
+            self.pdf_optimizer.encolar(path_documento)
 
     def _process_gastos_file(self, path_nuevo_archivo, nuevo_path, nombre, complemento):
         nombre_arch, extension_arch = os.path.splitext(nombre)
@@ -646,42 +1260,70 @@ class FileObserver(FileSystemEventHandler):
             nombre_completo = nombre_completo.replace(f'{complemento}.pdf', '.pdf')
         
         path_destino = os.path.join(nuevo_path, nombre_completo)
-        
-        if os.path.exists(path_destino):
-            self._merge_documents(path_destino, path_nuevo_archivo)
+
+        if self.gastos_coalescer:
+            self.gastos_coalescer.agregar(path_destino, path_nuevo_archivo)
         else:
-            path = self.file_manager.mueve_archivo(path_nuevo_archivo, path_destino, overwrite=True)
-            if path:
-                doc = {
-                    'name': nombre_completo,
-                    'current_path': nuevo_path,
-                    'visible': True,
-                }
-                self.document_processor.insertar_en_base_de_datos(doc)
+            self._process_gastos_parts(path_destino, [path_nuevo_archivo])
+
+    def _process_gastos_parts(self, path_destino, partes):
+        if not os.path.exists(path_destino):
+            # Si una parte no se puede mover (p. ej. el escáner aún la tiene abierta), la siguiente
+            # se usa como base; solo las partes que fallaron quedan en PATH_ARCHIVOS.
+            while partes:
+                parte = partes.pop(0)
+                if self._mueve_archivo(parte, path_destino, overwrite=True):
+                    current_path, name = os.path.split(path_destino)
+                    doc = {
+                        'name': name,
+                        'current_path': current_path,
+                        'visible': True,
+                    }
+                    self.document_processor.insertar_en_base_de_datos(doc)
+                    break
+                logging.error(f'No se pudo mover la parte {parte}; se intenta con la siguiente')
+            else:
+                return
+
+        if partes:
+            self._merge_documents(path_destino, partes)
+        self._optimizar(path_destino)
 
-    def _merge_documents(self, path_destino, path_nuevo_archivo):
-        resultado_unir = self.pdf_processor.unir_documentos(path_destino, path_nuevo_archivo)
-        if resultado_unir:
+    def _merge_documents(self, path_destino, paths_nuevos_archivos):
+        # Solo se registran y eliminan las partes que se unieron; las demás quedan en PATH_ARCHIVOS.
+        paths_nuevos_archivos = self.pdf_processor.unir_varios_documentos(path_destino, paths_nuevos_archivos)
+        if paths_nuevos_archivos:
             current_path, name = os.path.split(path_destino)
-            doc = self.database_manager.get_documento(name, current_path)
-            if doc:
-                doc['size'] = self.pdf_processor.get_size(path_destino)
-                self.database_manager.update_size(doc)
-                _, archivo_unido = os.path.split(path_nuevo_archivo)
-                log = {
-                    'log': f'Se unió el documento {archivo_unido}',
-                    'documents': doc['id']
-                }
-                self.database_manager.insertar_log(log)
-            
-            # Intentar eliminar archivo
+            num_paginas = self.pdf_processor.get_size(path_destino)
+            # Un segundo intento cubre el caso de un id en caché que ya no existe; registrar_union
+            # lo descarta de la caché y get_documento vuelve a consultar la base de datos.
+            for _ in range(2):
+                doc = self.database_manager.get_documento(name, current_path)
+                if not doc:
+                    break
+                doc['size'] = num_paginas
+                logs = []
+                for path_nuevo_archivo in paths_nuevos_archivos:
+                    _, archivo_unido = os.path.split(path_nuevo_archivo)
+                    logs.append({
+                        'log': f'Se unió el documento {archivo_unido}',
+                        'documents': doc['id']
+                    })
+                if self.database_manager.registrar_union(doc, logs):
+                    break
+
+            for path_nuevo_archivo in paths_nuevos_archivos:
+                self._eliminar_archivo_unido(path_nuevo_archivo)
+
+    def _eliminar_archivo_unido(self, path_nuevo_archivo):
+        # Intentar eliminar archivo
+        if not self.file_manager.eliminar_archivo(path_nuevo_archivo):
+            logging.info('No se pudo eliminar el archivo. Reintentando...')
+            time.sleep(2)
             if not self.file_manager.eliminar_archivo(path_nuevo_archivo):
-                logging.info('No se pudo eliminar el archivo. Reintentando...')
-                time.sleep(2)
-                if not self.file_manager.eliminar_archivo(path_nuevo_archivo):
-                    logging.info('No se pudo eliminar el archivo. Eliminar manualmente.')
-                else:
-                    logging.info('Se eliminó el archivo.')
+                logging.info('No se pudo eliminar el archivo. Eliminar manualmente.')
+            else:
+                logging.info('Se eliminó el archivo.')
 
 class ValijaDigitalApp:
     def __init__(self):
@@ -693,25 +1335,78 @@ class ValijaDigitalApp:
         self.file_manager = FileManager(self.config)
         self.path_manager = PathManager(self.config, self.csv_manager, self.pdf_processor)
         self.document_processor = DocumentProcessor(self.config, self.database_manager, self.pdf_processor)
+        self.pdf_optimizer = PDFOptimizer(self.config, self.pdf_processor) if self.config.OPTIMIZAR_PDF else None
+        self.trace_recorder = TraceRecorder(self.config, self.pdf_processor) if self.config.TRACE_FILENAME else None
+        self.evento_detener = threading.Event()
+        # Se activa al terminar el calentamiento, haya fallado o no algún paso; ver estado.
+        self.calentado = threading.Event()
+        self.fallas_calentamiento = []
         
         self.file_observer = FileObserver(
             self.config, self.csv_manager, self.pdf_processor, 
-            self.file_manager, self.path_manager, self.document_processor, self.database_manager
+            self.file_manager, self.path_manager, self.document_processor, self.database_manager,
+            self.pdf_optimizer, self.trace_recorder
         )
 
+    @property
+    def estado(self):
+        if not self.calentado.is_set():
+            return 'calentando'
+        return 'degradado' if self.fallas_calentamiento else 'listo'
+
+    def calentar(self):
+        """Precarga dependencias, CSV y carpetas antes del primer documento."""
+        inicio = time.monotonic()
+        pasos = [
+            ('dependencias', self.pdf_processor.precargar),
+            ('csv', self.csv_manager.precargar),
+            ('carpetas', self.path_manager.precargar_directorios),
+        ]
+        # Cada paso se ejecuta aunque falle el anterior; un paso falla si lanza una excepción o regresa False.
+        for nombre, paso in pasos:
+            try:
+                if paso() is False:
+                    self.fallas_calentamiento.append(nombre)
+            except Exception as e:
+                logging.error(f'Error durante el calentamiento ({nombre}): {e}')
+                self.fallas_calentamiento.append(nombre)
+        self.calentado.set()
+        if self.fallas_calentamiento:
+            logging.warning(f"Servicio degradado en {time.monotonic() - inicio:.1f} s; "
+                            f"fallaron: {', '.join(self.fallas_calentamiento)}")
+        else:
+            logging.info(f'Servicio listo en {time.monotonic() - inicio:.1f} s')
+
     def run(self):
+        from watchdog.observers import Observer
+
+        # Los índices se crean antes de observar: mientras SQLite construye un índice bloquea las
+        # escrituras, y los documentos que llegaran en ese tiempo no se podrían registrar.
+        if not self.database_manager.migrar():
+            self.fallas_calentamiento.append('índices')
+        threading.Thread(target=self.calentar, daemon=True).start()
         observer = Observer()
         observer.schedule(self.file_observer, path=self.config.PATH_ARCHIVOS, recursive=True)
         observer.start()
         logging.info('Observando directorio: %s', self.config.PATH_ARCHIVOS)
         
         try:
-            while True:
-                time.sleep(5)
+            while not self.evento_detener.is_set():
+                self.evento_detener.wait(5)
         except KeyboardInterrupt:
-            observer.stop()
+            pass
         finally:
+            observer.stop()
             observer.join()
+            if self.file_observer.gastos_coalescer:
+                self.file_observer.gastos_coalescer.vaciar()
+            if self.pdf_optimizer:
+                self.pdf_optimizer.detener()
+            if self.trace_recorder:
+                self.trace_recorder.detener()
+
+    def detener(self):
+        self.evento_detener.set()
 
 def main():
     app = ValijaDigitalApp()